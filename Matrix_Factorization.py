@@ -11,6 +11,15 @@ from google.colab import drive
 drive.mount('/content/drive')
 
 import math
+import os
+import json
+import time
+import asyncio
+import threading
+import collections
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Listener, Client
 import numpy as np
 import pandas as pd
 import numba as nb
@@ -43,6 +52,120 @@ def train_update_test_split_by_user(X: pd.DataFrame, frac_test_users: float):
 
     return (train_data, update_data, test_data)
 
+SHARD_COLUMNS = {"user_id": np.int32, "item_id": np.int32, "rating": np.float32}
+
+def _shard_column_path(shard_dir: str, shard: int, column: str):
+    return os.path.join(shard_dir, f"shard_{shard:05d}.{column}.bin")
+
+def convert_ratings_to_shards(
+    path: str,
+    shard_dir: str,
+    shard_size: int = 1_000_000,
+    sep: str = "::",
+    header: int = None,
+    columns: tuple = ("user_id", "item_id", "rating", "timestamp")
+):
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # Mapping of user_id and item_id to assigned integer ids, built while streaming
+    user_id_map, item_id_map = {}, {}
+    shard_sizes = []
+    rating_sum = 0.0
+
+    reader = pd.read_csv(
+        path,
+        sep=sep,
+        header=header,
+        names=list(columns),
+        usecols=list(SHARD_COLUMNS),
+        engine="python" if len(sep) > 1 else "c",
+        chunksize=shard_size
+    )
+
+    # Every chunk of the rating log becomes one shard of binary columns
+    for shard, chunk in enumerate(reader):
+        # Check for duplicate user-item ratings. Only done within a shard,
+        # duplicates in different shards are not detected
+        if chunk.duplicated(subset=["user_id", "item_id"]).sum() != 0:
+            raise ValueError(f"Duplicate user-item ratings in shard {shard}")
+
+        for user_id in chunk["user_id"].unique():
+            user_id_map.setdefault(user_id, len(user_id_map))
+        for item_id in chunk["item_id"].unique():
+            item_id_map.setdefault(item_id, len(item_id_map))
+
+        chunk = chunk.assign(
+            user_id=chunk["user_id"].map(user_id_map),
+            item_id=chunk["item_id"].map(item_id_map)
+        )
+        for column, dtype in SHARD_COLUMNS.items():
+            chunk[column].to_numpy(dtype=dtype).tofile(
+                _shard_column_path(shard_dir, shard, column)
+            )
+
+        shard_sizes.append(len(chunk))
+        rating_sum += chunk["rating"].sum()
+
+    meta = {
+        "shard_sizes": shard_sizes,
+        "global_mean": rating_sum / max(sum(shard_sizes), 1),
+        # Original ids in order of their assigned integer ids, numpy
+        # scalars are converted to the equivalent Python objects for JSON
+        "user_ids": [
+            user_id.item() if isinstance(user_id, np.generic) else user_id
+            for user_id in user_id_map
+        ],
+        "item_ids": [
+            item_id.item() if isinstance(item_id, np.generic) else item_id
+            for item_id in item_id_map
+        ],
+    }
+    with open(os.path.join(shard_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    return meta
+
+def load_shard_meta(shard_dir: str):
+    with open(os.path.join(shard_dir, "meta.json")) as f:
+        return json.load(f)
+
+def iterate_shard_buffers(
+    shard_dir: str,
+    shard_sizes: list,
+    buffer_size: int,
+    shuffle: bool = True
+):
+    # Visit shards in random order when shuffling
+    shards = np.random.permutation(len(shard_sizes)) if shuffle else range(len(shard_sizes))
+    for shard in shards:
+        n_ratings = shard_sizes[shard]
+        if n_ratings == 0:
+            continue
+
+        columns = {
+            column: np.memmap(
+                _shard_column_path(shard_dir, shard, column), dtype=dtype, mode="r"
+            )
+            for column, dtype in SHARD_COLUMNS.items()
+        }
+
+        # Visit buffer-sized windows of the shard and copy each one into
+        # memory in the layout _sgd expects. When shuffling, rows are
+        # gathered in shuffled order so the window is only copied once
+        starts = np.arange(0, n_ratings, buffer_size)
+        if shuffle:
+            starts = np.random.permutation(starts)
+        for start in starts:
+            stop = min(start + buffer_size, n_ratings)
+            rows = start + np.random.permutation(stop - start) if shuffle else slice(start, stop)
+            buffer = np.empty((stop - start, 3))
+            buffer[:, 0] = columns["user_id"][rows]
+            buffer[:, 1] = columns["item_id"][rows]
+            buffer[:, 2] = columns["rating"][rows]
+            yield buffer
+
+        del columns
+
 @nb.njit()
 def _sgd(
     X: np.ndarray,
@@ -65,21 +188,16 @@ def _sgd(
         np.random.shuffle(X)
 
         # Iterate through all ratings and update the model
-        for i in range(X.shape[0]):
-            user_id, item_id, rating = int(X[i, 0]), int(X[i, 1]), X[i, 2]
-
-            _sgd_update(
-                user_id=user_id,
-                item_id=item_id,
-                rating=rating,
-                global_mean=global_mean,
-                user_biases=user_biases,
-                item_biases=item_biases,
-                user_features=user_features,
-                item_features=item_features,
-                lr=lr,
-                reg_param=reg_param
-            )
+        _sgd_pass(
+            X=X,
+            global_mean=global_mean,
+            user_biases=user_biases,
+            item_biases=item_biases,
+            user_features=user_features,
+            item_features=item_features,
+            lr=lr,
+            reg_param=reg_param
+        )
 
         # Calculate error and print
         rmse = _calculate_rmse(
@@ -99,6 +217,36 @@ def _sgd(
 
     return user_features, item_features, user_biases, item_biases, train_rmse
 
+@nb.njit()
+def _sgd_pass(
+    X: np.ndarray,
+    global_mean: float,
+    user_biases: np.ndarray,
+    item_biases: np.ndarray,
+    user_features: np.ndarray,
+    item_features: np.ndarray,
+    lr: float,
+    reg_param: float
+):
+    # Single pass over the given ratings in their current order
+    for i in range(X.shape[0]):
+        user_id, item_id, rating = int(X[i, 0]), int(X[i, 1]), X[i, 2]
+
+        _sgd_update(
+            user_id=user_id,
+            item_id=item_id,
+            rating=rating,
+            global_mean=global_mean,
+            user_biases=user_biases,
+            item_biases=item_biases,
+            user_features=user_features,
+            item_features=item_features,
+            lr=lr,
+            reg_param=reg_param
+        )
+
+    return
+
 @nb.njit()
 def _sgd_update(
     user_id: int,
@@ -153,7 +301,7 @@ def _kernel_linear(
     result = global_mean + item_bias + user_bias + np.dot(user_feature_vec, item_feature_vec)
     return result
 
-@nb.njit()
+@nb.njit(nogil=True)
 def _predict(
     X: np.ndarray,
     global_mean: float,
@@ -202,6 +350,44 @@ def _predict(
         predictions.append(rating_pred)
 
     return predictions
+
+@nb.njit(nogil=True)
+def _recommend_scores(
+    user_ids: np.ndarray,
+    global_mean: float,
+    user_biases: np.ndarray,
+    item_biases: np.ndarray,
+    user_features: np.ndarray,
+    item_features: np.ndarray,
+    min_rating: int,
+    max_rating: int,
+    bound_ratings: bool
+):
+    n_items = item_features.shape[0]
+    scores = np.empty((user_ids.shape[0], n_items))
+
+    # Predict ratings of every item for each user, unknown users are -1
+    for i in range(user_ids.shape[0]):
+        user_id = user_ids[i]
+        user_known = user_id != -1
+
+        for item_id in range(n_items):
+            rating_pred = global_mean + item_biases[item_id]
+            if user_known:
+                rating_pred += user_biases[user_id] + np.dot(
+                    user_features[user_id, :], item_features[item_id, :]
+                )
+
+            # Bound ratings to min and max rating range
+            if bound_ratings:
+                if rating_pred > max_rating:
+                    rating_pred = max_rating
+                elif rating_pred < min_rating:
+                    rating_pred = min_rating
+
+            scores[i, item_id] = rating_pred
+
+    return scores
     
 @nb.njit()
 def _calculate_rmse(
@@ -240,6 +426,137 @@ def _calculate_rmse(
     rmse = np.sqrt(np.square(errors).mean())
     return rmse
 
+def _recv(conn, timeout: float):
+    # Connection.recv blocks forever if the other side hangs
+    if not conn.poll(timeout):
+        raise TimeoutError(f"No message within {timeout} seconds")
+    return conn.recv()
+
+def _accept_workers(
+    listener,
+    conns: list,
+    n_workers: int,
+    processes: list,
+    timeout: float,
+    logging: bool
+):
+    # Listener.accept has no timeout, so accept on a thread and give up
+    # when the timeout passes or a local worker exits before connecting
+    rejected = []
+    stopped = threading.Event()
+
+    def accept():
+        while len(conns) < n_workers:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # Listener was closed by the coordinator
+                if stopped.is_set():
+                    return
+
+                # Connection failed the handshake, keep waiting for workers
+                rejected.append(e)
+                if logging:
+                    print("Rejected worker connection:", repr(e))
+                continue
+            conns.append(conn)
+
+    accepter = threading.Thread(target=accept, daemon=True)
+    accepter.start()
+    deadline = time.time() + timeout
+    try:
+        while accepter.is_alive():
+            if any(process.exitcode is not None for process in processes):
+                raise RuntimeError("Worker exited before connecting")
+            if time.time() > deadline:
+                break
+            accepter.join(0.1)
+    finally:
+        stopped.set()
+
+    if len(conns) < n_workers:
+        raise TimeoutError(
+            f"Only {len(conns)} of {n_workers} workers connected, "
+            f"{len(rejected)} connections rejected"
+        )
+
+def run_sgd_worker(address, authkey: bytes, timeout: float = 600.0, shared: tuple = None):
+    # Worker of MF.fit_parallel. Can also be started by hand on another
+    # host with the TCP address and authkey of the coordinator. Workers
+    # forked by fit_parallel get shared memory arrays for the item
+    # parameters and for their own item updates
+    with Client(address, authkey=authkey) as conn:
+        setup = _recv(conn, timeout)
+        X = setup["X"]
+        user_biases = setup["user_biases"]
+        user_features = setup["user_features"]
+        item_biases = setup["item_biases"]
+        item_features = setup["item_features"]
+
+        # Forked workers inherit the random state of the coordinator
+        np.random.seed()
+
+        for epoch in range(setup["n_epochs"]):
+            X = X[np.random.permutation(X.shape[0])]
+
+            # Synchronize item parameters after every batch of ratings
+            for batch in np.array_split(X, setup["n_rounds"]):
+                if shared is None:
+                    # Only the items rated in the batch change
+                    items = np.unique(batch[:, 1].astype(np.int64))
+                    synced_features = item_features[items]
+                    synced_biases = item_biases[items]
+
+                _sgd_pass(
+                    X=batch,
+                    global_mean=setup["global_mean"],
+                    user_biases=user_biases,
+                    item_biases=item_biases,
+                    user_features=user_features,
+                    item_features=item_features,
+                    lr=setup["lr"],
+                    reg_param=setup["reg_param"]
+                )
+                if shared is None:
+                    # Send the updates of the batch and apply the rows
+                    # the coordinator changed since the last synchronization
+                    conn.send((
+                        items,
+                        item_features[items] - synced_features,
+                        item_biases[items] - synced_biases
+                    ))
+                    items, features, biases = _recv(conn, timeout)
+                    item_features[items] = features
+                    item_biases[items] = biases
+                else:
+                    # The shared parameters hold the last synchronized
+                    # values, write the updates next to them, only signal
+                    # the coordinator and copy back the combined parameters
+                    shared_features, shared_biases, own_features, own_biases = shared
+                    np.subtract(item_features, shared_features, out=own_features)
+                    np.subtract(item_biases, shared_biases, out=own_biases)
+                    conn.send(None)
+                    _recv(conn, timeout)
+                    item_features[:] = shared_features
+                    item_biases[:] = shared_biases
+
+            # Report error on the local shard
+            rmse = _calculate_rmse(
+                X=X,
+                global_mean=setup["global_mean"],
+                user_biases=user_biases,
+                item_biases=item_biases,
+                user_features=user_features,
+                item_features=item_features,
+                min_rating=setup["min_rating"],
+                max_rating=setup["max_rating"]
+            ) if X.shape[0] > 0 else 0.0
+            conn.send((rmse, X.shape[0]))
+
+        conn.send((user_features, user_biases))
+
+    return
+
 class MF():
 
     def __init__(
@@ -310,6 +627,254 @@ class MF():
 
         return self
 
+    def fit_shards(self, shard_dir: str, buffer_size: int = 1_000_000):
+        # Rating shards are created by convert_ratings_to_shards and
+        # are streamed from disk instead of being loaded into memory
+        meta = load_shard_meta(shard_dir)
+        shard_sizes = meta["shard_sizes"]
+        self.global_mean = meta["global_mean"]
+        self.user_id_map = {user_id: i for (i, user_id) in enumerate(meta["user_ids"])}
+        self.item_id_map = {item_id: i for (i, item_id) in enumerate(meta["item_ids"])}
+        self.n_users = len(self.user_id_map)
+        self.n_items = len(self.item_id_map)
+
+        # Initialize vector bias parameters
+        self.user_biases = np.zeros(self.n_users)
+        self.item_biases = np.zeros(self.n_items)
+
+        # Initialize matrices P and Q
+        self.user_features = np.random.normal(
+            self.init_mean, self.init_sd, (self.n_users, self.n_factors)
+        )
+        self.item_features = np.random.normal(
+            self.init_mean, self.init_sd, (self.n_items, self.n_factors)
+        )
+
+        self.train_rmse = []
+        for epoch in range(self.train_epochs):
+            # Perform stochastic gradient descent one buffer at a time
+            for buffer in iterate_shard_buffers(shard_dir, shard_sizes, buffer_size):
+                _sgd_pass(
+                    X=buffer,
+                    global_mean=self.global_mean,
+                    user_biases=self.user_biases,
+                    item_biases=self.item_biases,
+                    user_features=self.user_features,
+                    item_features=self.item_features,
+                    lr=self.train_lr,
+                    reg_param=self.reg_param
+                )
+
+            # Calculate error over all shards, in storage order, and print
+            squared_error, n_ratings = 0.0, 0
+            for buffer in iterate_shard_buffers(
+                shard_dir, shard_sizes, buffer_size, shuffle=False
+            ):
+                rmse = _calculate_rmse(
+                    X=buffer,
+                    global_mean=self.global_mean,
+                    user_biases=self.user_biases,
+                    item_biases=self.item_biases,
+                    user_features=self.user_features,
+                    item_features=self.item_features,
+                    min_rating=self.min_rating,
+                    max_rating=self.max_rating
+                )
+                squared_error += rmse ** 2 * buffer.shape[0]
+                n_ratings += buffer.shape[0]
+            rmse = np.sqrt(squared_error / max(n_ratings, 1))
+            self.train_rmse.append(rmse)
+
+            if self.logging:
+                print("Epoch ", epoch + 1, "/", self.train_epochs, " -  train_rmse:", rmse)
+
+        return self
+
+    def fit_parallel(
+        self,
+        X: pd.DataFrame,
+        n_workers: int = 2,
+        sync_every: int = 10_000,
+        address=None,
+        authkey: bytes = None,
+        spawn_workers: bool = True,
+        timeout: float = 600.0,
+        item_update: str = "mean"
+    ):
+        if item_update not in ("mean", "sum"):
+            raise ValueError("item_update must be 'mean' or 'sum'")
+
+        # Connections unpickle what they receive, so they must be authenticated
+        if authkey is None:
+            if not spawn_workers:
+                raise ValueError("authkey is required for workers started outside fit_parallel")
+            authkey = os.urandom(32)
+
+        X = self.preprocess_data(X, type="fit")
+        self.global_mean = X["rating"].mean()
+        X = X.to_numpy(dtype=np.float64, copy=True)
+
+        # Initialize vector bias parameters
+        self.user_biases = np.zeros(self.n_users)
+        self.item_biases = np.zeros(self.n_items)
+
+        # Initialize matrices P and Q
+        self.user_features = np.random.normal(
+            self.init_mean, self.init_sd, (self.n_users, self.n_factors)
+        )
+        self.item_features = np.random.normal(
+            self.init_mean, self.init_sd, (self.n_items, self.n_factors)
+        )
+
+        # Partition users between workers and remap them to local ids
+        worker_users = [np.arange(w, self.n_users, n_workers) for w in range(n_workers)]
+        rating_worker = X[:, 0].astype(np.int64) % n_workers
+        shards = []
+        for w in range(n_workers):
+            shard = X[rating_worker == w]
+            shard[:, 0] //= n_workers
+            shards.append(shard)
+
+        # Every worker synchronizes the same number of times per epoch
+        n_rounds = max(1, math.ceil(max(len(shard) for shard in shards) / sync_every))
+
+        # Address defaults to a local socket, pass (host, port) for TCP
+        processes, conns = [], []
+        try:
+            with Listener(address, authkey=authkey) as listener:
+                if spawn_workers:
+                    # Compile the kernels once so forked workers don't have to
+                    _sgd_pass(
+                        X=shards[0][:0],
+                        global_mean=self.global_mean,
+                        user_biases=self.user_biases,
+                        item_biases=self.item_biases,
+                        user_features=self.user_features,
+                        item_features=self.item_features,
+                        lr=self.train_lr,
+                        reg_param=self.reg_param
+                    )
+                    _calculate_rmse(
+                        X=shards[0][:1],
+                        global_mean=self.global_mean,
+                        user_biases=self.user_biases,
+                        item_biases=self.item_biases,
+                        user_features=self.user_features,
+                        item_features=self.item_features,
+                        min_rating=self.min_rating,
+                        max_rating=self.max_rating
+                    )
+
+                    context = mp.get_context("fork")
+
+                    # Forked workers exchange item parameters and updates
+                    # through shared memory instead of the connection
+                    def shared_array(*shape):
+                        return np.frombuffer(
+                            context.RawArray("d", math.prod(shape))
+                        ).reshape(shape)
+
+                    shared_features = shared_array(n_workers, self.n_items, self.n_factors)
+                    shared_biases = shared_array(n_workers, self.n_items)
+                    shared_item_features = shared_array(self.n_items, self.n_factors)
+                    shared_item_biases = shared_array(self.n_items)
+                    shared_item_features[:] = self.item_features
+                    shared_item_biases[:] = self.item_biases
+                    self.item_features = shared_item_features
+                    self.item_biases = shared_item_biases
+
+                    processes = [
+                        context.Process(
+                            target=run_sgd_worker,
+                            args=(listener.address, authkey, timeout, (
+                                shared_item_features,
+                                shared_item_biases,
+                                shared_features[w],
+                                shared_biases[w]
+                            ))
+                        )
+                        for w in range(n_workers)
+                    ]
+                    for process in processes:
+                        process.start()
+
+                _accept_workers(listener, conns, n_workers, processes, timeout, self.logging)
+
+            for conn, shard, users in zip(conns, shards, worker_users):
+                conn.send({
+                    "X": shard,
+                    "global_mean": self.global_mean,
+                    "user_biases": self.user_biases[users],
+                    "user_features": self.user_features[users],
+                    "item_biases": self.item_biases,
+                    "item_features": self.item_features,
+                    "n_epochs": self.train_epochs,
+                    "n_rounds": n_rounds,
+                    "lr": self.train_lr,
+                    "reg_param": self.reg_param,
+                    "min_rating": self.min_rating,
+                    "max_rating": self.max_rating
+                })
+
+            self.train_rmse = []
+            for epoch in range(self.train_epochs):
+                for _ in range(n_rounds):
+                    updates = [_recv(conn, timeout) for conn in conns]
+
+                    # "mean" averages the item replicas of the workers, so
+                    # every step is divided by n_workers. "sum" applies the
+                    # updates of all workers, as sequential SGD over the same
+                    # ratings would, and converges faster per epoch, but a
+                    # popular item gets up to n_workers steps per sync and a
+                    # learning rate that works for fit can diverge
+                    scale = 1.0 if item_update == "sum" else 1.0 / n_workers
+                    if spawn_workers:
+                        for own_features, own_biases in zip(shared_features, shared_biases):
+                            self.item_features += scale * own_features
+                            self.item_biases += scale * own_biases
+                        for conn in conns:
+                            conn.send(None)
+                        continue
+
+                    for items, feature_updates, bias_updates in updates:
+                        self.item_features[items] += scale * feature_updates
+                        self.item_biases[items] += scale * bias_updates
+
+                    # Send back every row that changed in this round
+                    items = np.unique(np.concatenate([update[0] for update in updates]))
+                    for conn in conns:
+                        conn.send((items, self.item_features[items], self.item_biases[items]))
+
+                # Combine error of all shards and print
+                errors = [_recv(conn, timeout) for conn in conns]
+                n_ratings = sum(n for (_, n) in errors)
+                rmse = np.sqrt(sum(rmse ** 2 * n for (rmse, n) in errors) / n_ratings)
+                self.train_rmse.append(rmse)
+
+                if self.logging:
+                    print("Epoch ", epoch + 1, "/", self.train_epochs, " -  train_rmse:", rmse)
+
+            # Collect user parameters of every worker
+            for conn, users in zip(conns, worker_users):
+                self.user_features[users], self.user_biases[users] = _recv(conn, timeout)
+
+            # Don't keep the model in shared memory
+            self.item_features = np.array(self.item_features)
+            self.item_biases = np.array(self.item_biases)
+
+        finally:
+            # Closing the connections stops workers blocked on a message,
+            # terminate the ones that don't exit on their own
+            for conn in conns:
+                conn.close()
+            for process in processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+
+        return self
+
     def predict(self, X: pd.DataFrame):
         # If empty return empty list
         if X.shape[0] == 0:
@@ -532,6 +1097,268 @@ class MF_Interface():
         recom = self.matrix_fact.recommend(user=user, amount=amount, items_known=items_known)
         return recom
 
+# Copy of the fields of MF that MF_Server reads when scoring
+ServedModel = collections.namedtuple("ServedModel", [
+    "global_mean",
+    "user_id_map",
+    "item_id_map",
+    "user_biases",
+    "item_biases",
+    "user_features",
+    "item_features",
+    "min_rating",
+    "max_rating",
+    "bound_ratings",
+    "item_ids"
+])
+
+def snapshot_model(model: MF):
+    # Read-only copy of the model, so retraining it in place does not
+    # change what is served until it is swapped in again
+    arrays = [
+        np.array(array)
+        for array in (
+            model.user_biases,
+            model.item_biases,
+            model.user_features,
+            model.item_features
+        )
+    ]
+    for array in arrays:
+        array.flags.writeable = False
+
+    return ServedModel(
+        model.global_mean,
+        model.user_id_map.copy(),
+        model.item_id_map.copy(),
+        *arrays,
+        model.min_rating,
+        model.max_rating,
+        model.bound_ratings,
+        np.array(sorted(model.item_id_map, key=model.item_id_map.get))
+    )
+
+class MF_Server():
+
+    def __init__(
+        self,
+        model: MF,
+        max_batch_size: int = 256,
+        max_latency: float = 0.005,
+        n_threads: int = 1,
+        n_latencies: int = 10_000
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.n_threads = n_threads
+        self.latencies = collections.deque(maxlen=n_latencies)
+        self.batch_sizes = collections.Counter()
+        self.model = model if isinstance(model, ServedModel) else snapshot_model(model)
+        self.closed = True
+
+    async def swap_model(self, model: MF):
+        # Batches keep the snapshot they were started with, so requests
+        # already being scored are answered by the previous model. The
+        # snapshot is taken on another thread so requests keep being
+        # served, or can be taken beforehand with snapshot_model
+        if not isinstance(model, ServedModel):
+            loop = asyncio.get_running_loop()
+            model = await loop.run_in_executor(None, snapshot_model, model)
+        self.model = model
+
+    async def start(self):
+        self.closed = False
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=self.n_threads)
+        self.pending = set()
+        self.batcher = asyncio.create_task(self._batch_requests())
+        return self
+
+    async def stop(self):
+        # Answer every request queued before stopping, fail the ones
+        # queued behind it
+        self.closed = True
+        await self.queue.put(None)
+        await self.batcher
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None and not item[1].done():
+                item[1].set_exception(RuntimeError("MF_Server is stopped"))
+        await asyncio.gather(*self.pending)
+        self.executor.shutdown()
+
+    async def predict(self, user: int, item: int):
+        return await self._submit(("predict", user, item))
+
+    async def recommend(self, user: int, amount: int, items_known: list = None):
+        if not isinstance(amount, (int, np.integer)) or amount < 0:
+            raise ValueError("amount must be a non-negative integer")
+        return await self._submit(("recommend", user, amount, items_known))
+
+    async def _submit(self, request: tuple):
+        if self.closed:
+            raise RuntimeError("MF_Server is not running")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        start = loop.time()
+        await self.queue.put((request, future))
+        result = await future
+        self.latencies.append(loop.time() - start)
+        return result
+
+    async def _batch_requests(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            first = await self.queue.get()
+            if first is None:
+                return
+
+            # Collect requests until the batch is full or the window closes
+            batch = [first]
+            deadline = loop.time() + self.max_latency
+            stop = False
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self.batch_sizes[len(batch)] += 1
+            task = asyncio.create_task(self._score_batch(batch))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+
+            if stop:
+                return
+
+    async def _score_batch(self, batch: list):
+        loop = asyncio.get_running_loop()
+        requests = [request for (request, _) in batch]
+        futures = [future for (_, future) in batch]
+
+        try:
+            results = await loop.run_in_executor(
+                self.executor, self._score, self.model, requests
+            )
+        except Exception as e:
+            for future in futures:
+                # Skip requests cancelled by the caller
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _score(self, model: ServedModel, requests: list):
+        # A failing request gets its exception as result, so it doesn't
+        # fail the other requests of the batch
+        results = [None] * len(requests)
+
+        # Look up the ids of all predict requests
+        predict_requests, X = [], []
+        for i, request in enumerate(requests):
+            if request[0] != "predict":
+                continue
+            _, user, item = request
+            try:
+                X.append([model.user_id_map.get(user, -1), model.item_id_map.get(item, -1)])
+            except TypeError as e:
+                results[i] = e
+                continue
+            predict_requests.append(i)
+
+        # Score all predict requests with one kernel call
+        if predict_requests:
+            predictions = _predict(
+                X=np.array(X, dtype=np.float64),
+                global_mean=model.global_mean,
+                user_biases=model.user_biases,
+                item_biases=model.item_biases,
+                user_features=model.user_features,
+                item_features=model.item_features,
+                min_rating=model.min_rating,
+                max_rating=model.max_rating,
+                bound_ratings=model.bound_ratings
+            )
+            for i, prediction in zip(predict_requests, predictions):
+                results[i] = prediction
+
+        # Look up the users of all recommend requests
+        recommend_requests, user_ids = [], []
+        for i, request in enumerate(requests):
+            if request[0] != "recommend":
+                continue
+            try:
+                user_ids.append(model.user_id_map.get(request[1], -1))
+            except TypeError as e:
+                results[i] = e
+                continue
+            recommend_requests.append(i)
+
+        # Score all recommend requests with one kernel call
+        if recommend_requests:
+            scores = _recommend_scores(
+                user_ids=np.array(user_ids, dtype=np.int64),
+                global_mean=model.global_mean,
+                user_biases=model.user_biases,
+                item_biases=model.item_biases,
+                user_features=model.user_features,
+                item_features=model.item_features,
+                min_rating=model.min_rating,
+                max_rating=model.max_rating,
+                bound_ratings=model.bound_ratings
+            )
+
+            for row, i in enumerate(recommend_requests):
+                _, user, amount, items_known = requests[i]
+                user_scores = scores[row]
+
+                try:
+                    # Filter by items that the user does not know
+                    if items_known is not None:
+                        known = [
+                            model.item_id_map[item]
+                            for item in items_known if item in model.item_id_map
+                        ]
+                        user_scores[known] = -np.inf
+
+                    # Sort and keep top n items
+                    amount = min(amount, int(np.isfinite(user_scores).sum()))
+                    top = np.argpartition(-user_scores, max(amount - 1, 0))[:amount]
+                    top = top[np.argsort(-user_scores[top])]
+                    results[i] = pd.DataFrame({
+                        "user_id": user,
+                        "item_id": model.item_ids[top],
+                        "rating_pred": user_scores[top]
+                    })
+                except Exception as e:
+                    results[i] = e
+
+        return results
+
+    def stats(self):
+        latencies = np.array(self.latencies)
+        return {
+            "p50_latency": np.percentile(latencies, 50) if len(latencies) else None,
+            "p99_latency": np.percentile(latencies, 99) if len(latencies) else None,
+            "batch_sizes": dict(sorted(self.batch_sizes.items()))
+        }
+
 movie_data = pd.read_csv(
     "drive/My Drive/University/Proposal/Movie_Dataset/ratings.dat", 
     sep="::", 
@@ -702,4 +1529,128 @@ model = MF_Interface(
 model.build()
 
 recommendation = model.get_recommendation_for_user(user=200)
-print(recommendation)
\ No newline at end of file
+print(recommendation)
+
+shard_dir = "drive/My Drive/University/Proposal/Movie_Dataset/ratings_shards"
+convert_ratings_to_shards(
+    path="drive/My Drive/University/Proposal/Movie_Dataset/ratings.dat",
+    shard_dir=shard_dir,
+    shard_size=100_000
+)
+
+shard_model = MF(
+    n_factors=90,
+    train_epochs=5,
+    update_epochs=5,
+    reg_param=0.02,
+    train_lr=0.01,
+    update_lr=0.01,
+    init_mean=0,
+    init_sd=0.1,
+    min_rating=0,
+    max_rating=5,
+    bound_ratings=True,
+    logging=True,
+)
+shard_model.fit_shards(shard_dir=shard_dir, buffer_size=50_000)
+
+worker_counts = [1, 2, 4, 8]
+item_updates = ["mean", "sum"]
+parallel_times = np.zeros((len(item_updates), len(worker_counts)))
+parallel_rmse = [[], []]
+
+start = time.time()
+single_model = MF(
+    n_factors=90,
+    train_epochs=5,
+    update_epochs=5,
+    reg_param=0.02,
+    train_lr=0.01,
+    update_lr=0.01,
+    init_mean=0,
+    init_sd=0.1,
+    min_rating=0,
+    max_rating=5,
+    bound_ratings=True,
+    logging=False,
+).fit(movie_data)
+single_time = time.time() - start
+
+for j in range(len(item_updates)):
+    for i in range(len(worker_counts)):
+        parallel_model = MF(
+            n_factors=90,
+            train_epochs=5,
+            update_epochs=5,
+            reg_param=0.02,
+            train_lr=0.01,
+            update_lr=0.01,
+            init_mean=0,
+            init_sd=0.1,
+            min_rating=0,
+            max_rating=5,
+            bound_ratings=True,
+            logging=False,
+        )
+        start = time.time()
+        parallel_model.fit_parallel(
+            movie_data,
+            n_workers=worker_counts[i],
+            sync_every=10_000,
+            item_update=item_updates[j]
+        )
+        parallel_times[j, i] = time.time() - start
+        parallel_rmse[j].append(parallel_model.train_rmse)
+
+plt.figure(figsize=(15, 8))
+for j in range(len(item_updates)):
+    plt.plot(
+        worker_counts,
+        len(movie_data) * 5 / parallel_times[j],
+        label=f"fit_parallel, item_update={item_updates[j]}"
+    )
+plt.axhline(len(movie_data) * 5 / single_time, color="gray", linestyle="--", label="fit")
+plt.title('Training Throughput for Different Worker Counts')
+plt.xlabel('Workers')
+plt.ylabel('Ratings per Second')
+plt.legend()
+plt.show()
+
+plt.figure(figsize=(15, 8))
+plt.plot(range(1, 6), single_model.train_rmse, label="fit")
+for j in range(len(item_updates)):
+    for i in range(len(worker_counts)):
+        plt.plot(
+            range(1, 6),
+            parallel_rmse[j][i],
+            label=f"fit_parallel, item_update={item_updates[j]}, {worker_counts[i]} workers"
+        )
+plt.title('Train RMSE per Epoch for Averaged and Summed Item Updates')
+plt.xlabel('Epoch')
+plt.ylabel('RMSE')
+plt.legend()
+plt.show()
+
+async def serve_recommendations(users: list):
+    server = await MF_Server(model=model.matrix_fact, max_batch_size=64, max_latency=0.005).start()
+    recommendations = await asyncio.gather(
+        *[server.recommend(user=user, amount=10) for user in users]
+    )
+
+    # Swap in the retrained model while requests are queued and in flight
+    requests = [
+        asyncio.create_task(server.recommend(user=user, amount=10)) for user in users
+    ]
+    await asyncio.sleep(0)
+    await server.swap_model(parallel_model)
+    swapped = await asyncio.gather(*requests)
+    assert len(swapped) == len(users) and all(
+        recommendation is not None for recommendation in swapped
+    )
+    recommendations += swapped
+
+    await server.stop()
+    print(server.stats())
+    return recommendations
+
+recommendations = asyncio.run(serve_recommendations(users=list(range(1, 201))))